@@ -7,35 +7,35 @@ from exceptions import Unsolvable
 
 log = logging.getLogger(__name__)
 
+# Single-bit constants for values 1..64, indexed by value - 1; plenty
+# for any printable puzzle and saves the shift in the hot paths
+BIT = tuple(1 << i for i in range(64))
+
 
 class BaseCell:
 	"""
 	Base class for a cell. A cell knows its location and the
 	puzzle it is part of.
-	"""
-	def __init__(self, r: int, c: int, parent):
-		self._row = r
-		self._col = c
-		self._parent = parent
-
-	@property
-	def row(self):
-		"""Row number of cell"""
-		return self._row
 
-	@property
-	def col(self):
-		"""Col number of cell"""
-		return self._col
+	Cells use __slots__; a puzzle allocates N*N of them and the hot
+	paths read their attributes constantly, so a fixed layout pays off.
+	"""
+	__slots__ = ('row', 'col', 'parent', '_on_notval', '_on_gotval')
 
-	@property
-	def parent(self):
-		"""Puzzle we belong to"""
-		return self._parent
+	def __init__(self, r: int, c: int, parent):
+		# Location and container are set once and never change; plain
+		# attributes, a property per read costs a Python call each
+		self.row = r
+		self.col = c
+		self.parent = parent
+		# Resolve the parent's callbacks once; a hasattr per setval/xclude
+		# call would redo the attribute discovery millions of times
+		self._on_notval = getattr(parent, 'cellnotval', None)
+		self._on_gotval = getattr(parent, 'cellgotval', None)
 
 	@property
 	def name(self):
-		loc = getattr(self._parent, 'name', '')
+		loc = getattr(self.parent, 'name', '')
 		if loc:
 			loc += ': '
 		return f'{loc}cell({self.row + 1}, {self.col + 1})'
@@ -45,18 +45,42 @@ class NCell(BaseCell):
 	"""
 	A cell that can hold exactly one value in the range 1..N
 
-	A cell starts as a set holding the values 1..N. As long as
-	its value has not yet been determined, its value is the set
-	of all (still) possible values. Once its value is determined,
-	its value is the corresponding number.
+	The still possible values are kept as an integer bitmask where
+	bit k is set iff value k+1 is still a candidate. A cell starts
+	with all N low bits set. Once its value is determined, the mask
+	is replaced by the value itself and the `_fixed` flag is raised,
+	so the state test is a plain attribute read. Candidate operations
+	are thus single C-level integer ops instead of set manipulations,
+	and the whole state is two immutable values that can be backed up
+	by assignment.
 	"""
+	__slots__ = ('_fixed', 'val', 'idx', 'bit')
+
 	def __init__(self, N: int, r: int, c: int, parent):
 		super().__init__(r, c, parent)
-		self._val = {i for i in range(1, N + 1)}
-
-	@property
-	def val(self):
-		return self._val
+		self._fixed = False
+		# The fixed value, or the candidate bitmask while unsolved
+		self.val = (1 << N) - 1
+		# Position as flat index and as single bit in an N*N mask,
+		# precomputed since propagation needs them on every event
+		self.idx = r * N + c
+		self.bit = 1 << self.idx
+
+	def has(self, num: int) -> bool:
+		"""Is num still a candidate?"""
+		return not self._fixed and self.val & BIT[num - 1] != 0
+
+	def ncand(self) -> int:
+		"""Number of remaining candidates"""
+		return 1 if self._fixed else self.val.bit_count()
+
+	def candidates(self):
+		"""Iterate over the remaining candidate values"""
+		m = self.val
+		while m:
+			b = m & -m
+			yield b.bit_length()
+			m ^= b
 
 	def setval(self, num, comment='unknown reason'):
 		"""
@@ -72,20 +96,27 @@ class NCell(BaseCell):
 		we propagate this to the parent puzzle by calling its cellgotvalue
 		method.
 		"""
-		log.debug(f'Set {self.name} = {num} ({comment})')
-		if isinstance(self._val, int):
-			if self._val == num:
+		if log.isEnabledFor(logging.DEBUG):
+			# self.name formats a string, avoid that with debug logging off
+			log.debug(f'Set {self.name} = {num} ({comment})')
+		if self._fixed:
+			if self.val == num:
 				return
-			raise Unsolvable(f'{self.name} already set to {self._val}')
-		if num not in self._val:
+			raise Unsolvable(f'{self.name} already set to {self.val}')
+		rest = self.val & ~BIT[num - 1]
+		if rest == self.val:
 			raise Unsolvable(f'{self.name} value {num} not available')
-		if hasattr(self.parent, 'cellnotval'):
+		self.parent.journal.append((self, self.val))
+		if self._on_notval is not None:
 			# Exlude all other currently existing values
-			for v in self._val - {num}:
-				self.parent.cellnotval(self, v)
-		self._val = num
-		if hasattr(self.parent, 'cellgotval'):
-			self.parent.cellgotval(self, num)
+			while rest:
+				b = rest & -rest
+				self._on_notval(self, b.bit_length())
+				rest ^= b
+		self._fixed = True
+		self.val = num
+		if self._on_gotval is not None:
+			self._on_gotval(self, num)
 
 	def xclude(self, num: int):
 		"""
@@ -102,18 +133,20 @@ class NCell(BaseCell):
 		When the value was indeed included before, propagate this
 		to the parent puzzle by calling its cellnotvalue method.
 		"""
-		if isinstance(self._val, int):
+		if self._fixed:
 			return
-		if num not in self._val:
+		rest = self.val & ~BIT[num - 1]
+		if rest == self.val:
 			return
-		self._val.discard(num)
-		if len(self._val) == 0:
+		if rest == 0:
 			raise Unsolvable(f'No candidate for {self.name}')
-		if hasattr(self.parent, 'cellnotval'):
-			self.parent.cellnotval(self, num)
+		self.parent.journal.append((self, self.val))
+		self.val = rest
+		if self._on_notval is not None:
+			self._on_notval(self, num)
 
 	def is_fix(self):
-		return isinstance(self._val, int)
+		return self._fixed
 
 	def getany(self):
 		"""
@@ -121,22 +154,15 @@ class NCell(BaseCell):
 		"""
 		if self.is_fix():
 			raise ValueError(f'Cell C({self.row}, {self.col}) is fixed')
-		return iter(self._val).__next__()
-
-	def state(self):
-		"""
-		Value representing the current state.
-
-		Must not contain any reference to the original. Thus we need to
-		use a copy for sets.
-		"""
-		if isinstance(self._val, int):
-			return self._val
-		else:
-			return self._val.copy()
+		return (self.val & -self.val).bit_length()
 
 	def restore(self, val):
 		"""
-		Restore value from a backup
+		Restore value from a journal record
+
+		Flag and mask are packed into one int, negated when fixed. The
+		records written by setval and xclude are always unfixed masks,
+		but the encoding keeps the sign convention of earlier snapshots.
 		"""
-		self._val = val
+		self._fixed = val < 0
+		self.val = -val if val < 0 else val
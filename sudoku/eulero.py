@@ -1,5 +1,4 @@
 #!/usr/bin/env python3
-import types
 import logging
 import re
 
@@ -9,6 +8,11 @@ from exceptions import Unsolvable
 
 log = logging.getLogger(__name__)
 
+euleroval_re = re.compile('([A-Z]*)([0-9]*)')
+
+# Letters for left square values, indexed by value - 1
+LETTER = tuple(chr(ord('A') + i) for i in range(26))
+
 
 def euleroval(v:str):
 	"""
@@ -23,8 +27,14 @@ def euleroval(v:str):
 	  A list of (pos, val) tuples. `pos` is the number of the Eulero square (left 0,
 	  right 1) `val` is the value to be set in the magic square at that position.
 	"""
+	# The overwhelmingly common givens are a plain number or a single
+	# letter; handle those without the regex engine
+	if v.isdigit():
+		return [(1, int(v))]
+	if len(v) == 1 and 'A' <= v <= 'Z':
+		return [(0, ord(v) - ord('A') + 1)]
 	res = []
-	match = re.match('([A-Z]*)([0-9]*)', v)
+	match = euleroval_re.match(v)
 	ltr, num = match.group(1, 2)
 	if len(ltr) > 0:
 		res.append((0, ord(ltr[0]) - ord('A') + 1))
@@ -54,16 +64,25 @@ class Eulero(BasePuzzle):
 	- square (list): A list of two magic squares, the first (primary) square
 	  represents the numbers in the left positions, the second square represents
 	  the numbers in the right positions.
-	- pairs (dict): A dictionary where the keys are all tuples (i, j) with
-	  i in 0..n-1 and j in 0..n-1. Each value is a set of cells in the primary
-	  magic square. The set contains those positions where the given tuple can
-	  still occur. Initially, when the Eulero is empty and no givens are set,
-	  all positions are possible. Whenever a cell receives a value, the sets can
-	  be reduced accordingly.
+	- pairs (list): A nested list indexed by left value then right value
+	  (index 0 unused). Each entry is an int bitmask over the positions of
+	  the primary magic square, bit row*n+col set iff the given pair can
+	  still occur at that position. Initially, when the Eulero is empty and
+	  no givens are set, all positions are possible. Whenever a cell
+	  receives a value, the masks can be reduced accordingly. Once a pair
+	  has been located, the mask is replaced by the primary cell at its
+	  position. Plain list indexing avoids building and hashing a tuple key
+	  on every propagation step.
 	"""
+	__slots__ = (
+		'n', 'digits', 'square', 'pcells', 'pairs', 'pairnames', 'posnames',
+		'vals',
+	)
+
 	def __init__(self, n: int = 5):
 		super().__init__()
 		self.n = n
+		self.vals = range(1, n + 1)
 		self.digits = len(str(n))
 		self.square = [Magicsquare(n) for i in range(2)]
 		self.square[0].name = 'Left'
@@ -72,45 +91,58 @@ class Eulero(BasePuzzle):
 		self.square[1].name = 'Right'
 		self.square[1].pos = 1
 		self.square[1].parent = self
+		# Direct cross references, so hot code need not compute 1-pos
+		self.square[0].other = self.square[1]
+		self.square[1].other = self.square[0]
+		# One shared journal: cell changes in either square must be
+		# undone when the Eulero backtracks
+		self.square[0].journal = self.journal
+		self.square[1].journal = self.journal
+		self.pcells = self.square[0].cells
 		self.remain = 2 * self.square[0].remain
-		self.pairs = {
-			(i, j): {c for c in self.square[0].cells}
-			for i in range(1, n + 1) for j in range(1, n + 1)
-		}
+		self.pairs = [
+			[(1 << (n * n)) - 1] * (n + 1) for i in range(n + 1)
+		]
 		self.myrules = self.square[0].myrules + self.square[1].myrules + [
 			self.rule_singlepairpos
 		]
+		# Names are asked for in log messages all over the propagation
+		# path, format them once instead of per call
+		self.pairnames = [
+			[
+				chr(ord('A') - 1 + i) + '{n:>{w}}'.format(n=j, w=self.digits)
+				for j in range(n + 1)
+			]
+			for i in range(n + 1)
+		]
+		self.posnames = [
+			f'({row + 1},{col + 1})' for row in range(n) for col in range(n)
+		]
 
 	def pairname(self, pair):
-		return chr(ord('A') - 1 + pair[0]) + '{n:>{w}}'.format(n=pair[1], w=self.digits)
+		return self.pairnames[pair[0]][pair[1]]
 
 	def posname(self, row, col):
-		return f'({row + 1},{col + 1})'
-
-	def pairstate(self):
-		return {
-			pair: val.copy() if isinstance(val, set) else val
-			for pair, val in self.pairs.items()
-		}
+		return self.posnames[row * self.n + col]
 
 	def state(self):
 		"""
-		Current state of the puzzle
+		The counters to save next to a journal mark
+
+		Cells and pair masks are undone via the shared journal, only
+		the three remain counters need an explicit copy.
 		"""
-		return [(s.state(), s.remain) for s in self.square], self.pairstate()
+		return self.remain, self.square[0].remain, self.square[1].remain
 
 	def restorestate(self, state):
 		"""
-		Restore puzzle to the given state
+		Restore the counters saved by state()
 		"""
-		squares, self.pairs = state
-		for i, (s, r) in enumerate(squares):
-			self.square[i].restorestate(s)
-			self.square[i].remain = r
+		self.remain, self.square[0].remain, self.square[1].remain = state
 
 	def pcell(self, row, col):
 		"""Primary cell at a position"""
-		return self.square[0].getcell(row, col)
+		return self.pcells[row * self.n + col]
 
 	def findtry(self) -> NCell:
 		"""
@@ -119,48 +151,45 @@ class Eulero(BasePuzzle):
 		res = None
 		if self.square[0].remain != 0:
 			res = self.square[0].findtry()
-		if res is not None and len(res.val) == 2:
-			return res
+			if res is not None and res.ncand() == 2:
+				return res
 		r2 = self.square[1].findtry()
 		if res is None:
 			return r2
 		elif r2 is None:
 			return res
-		elif len(res.val) < len(r2.val):
+		elif res.ncand() < r2.ncand():
 			return res
 		else:
 			return r2
 
-	def setpair(self, pair:tuple, row, col):
+	def setpair(self, pair:tuple, cell):
 		"""
 		Set location of a pair
 
-		Must be called whenever both locations in an Eulero cell, receive a
-		fixed value. This will mark the pair as being found and will exclude
-		the left value from cells where the right value has already been found
-		and the right value from cells where the left value has already been
-		found.
+		Must be called whenever both locations in an Eulero cell receive a
+		fixed value; `cell` is the primary cell at that position and the
+		caller has already checked that the pair is still unlocated. This
+		will mark the pair as being found and will exclude the left value
+		from cells where the right value has already been found and the
+		right value from cells where the left value has already been found.
 		"""
-		pairval = self.pairs[pair]
-		cell = self.pcell(row, col)
-		if isinstance(pairval, BaseCell):
-			# Pair has been found already
-			if pairval.row != row or pairval.col != col:
-				raise Unsolvable(
-					f'Pair {self.pairname(pair)} already at {self.posname(pairval.row, pairval.col)})'
-				)
-			log.warning(f'Pair {self.pair2str(pair)} has already been set')
-			return
-		log.debug(f'Pair {self.pairname(pair)} found at {self.posname(row, col)}')
-		self.pairs[pair] = self.pcell(row, col)
-		# Remove left value from cells where the right value is already set to
-		# the right value of the pair. Same for the right value
-		for (c0, c1) in zip(self.square[0].cells, self.square[1].cells):
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug(f'Pair {self.pairname(pair)} found at {self.posname(cell.row, cell.col)}')
+		prow = self.pairs[pair[0]]
+		self.journal.append((prow, pair[1], prow[pair[1]]))
+		prow[pair[1]] = cell
+		# Remove the right value from cells whose left value is already set to
+		# the left value of the pair. Same for the left value. The reverse
+		# index gives us the holders directly instead of scanning all cells.
+		rcells = self.square[1].cells
+		lcells = self.pcells
+		for c0 in self.square[0].cells_by_val[pair[0]]:
 			if c0 is cell: continue
-			if c0.val == pair[0]:
-				c1.xclude(pair[1])
-			if c1.val == pair[1]:
-				c0.xclude(pair[0])
+			self.exclude(rcells[c0.idx], pair[1])
+		for c1 in self.square[1].cells_by_val[pair[1]]:
+			if c1.idx == cell.idx: continue
+			self.exclude(lcells[c1.idx], pair[0])
 
 	def cellgotval(self, square, cell, value):
 		"""
@@ -179,67 +208,112 @@ class Eulero(BasePuzzle):
 		C is in from the set of P.
 		"""
 		self.remain -= 1
-		pos, row, col = square.pos, cell.row, cell.col
-		othercell = self.square[1-pos].getcell(row, col)
+		pos = square.pos
+		othercell = square.other.cells[cell.idx]
 		# Construct tuples from values at the variable positions pos and 1-pos
 		lpair = [-1, -1]
 		lpair[pos] = value
 		if othercell.is_fix():
-			# We found the location of a new pair
+			# We found the location of a new pair. The found check is done
+			# here so setpair need not rediscover pairval and the primary cell
 			lpair[1-pos] = othercell.val
-			self.setpair(tuple(lpair), row, col)
+			pair = tuple(lpair)
+			pairval = self.pairs[pair[0]][pair[1]]
+			cell0 = cell if pos == 0 else othercell
+			if isinstance(pairval, BaseCell):
+				# Pair has been found already
+				if pairval is not cell0:
+					raise Unsolvable(
+						f'Pair {self.pairname(pair)} already at {self.posname(pairval.row, pairval.col)})'
+					)
+				log.warning(f'Pair {self.pair2str(pair)} has already been set')
+				return
+			self.setpair(pair, cell0)
 		else:
 			# We fixed one value (left or right) in a previously empty cell.
 			# Exclude all values from the other cell position, where the
 			# corresponding pair has been found already
-			for otherval in othercell.val.copy():
+			for otherval in list(othercell.candidates()):
 				lpair[1-pos] = otherval
-				if isinstance(self.pairs[tuple(lpair)], BaseCell):
-					log.debug(f'Exclude {otherval} from {othercell.name}')
-					othercell.xclude(otherval)
+				if isinstance(self.pairs[lpair[0]][lpair[1]], BaseCell):
+					if log.isEnabledFor(logging.DEBUG):
+						log.debug(f'Exclude {otherval} from {othercell.name}')
+					self.exclude(othercell, otherval)
 
 	def cellnotval(self, square, cell, value):
 		"""
 		Remove potential pair locations when a value has been excluded from a cell
 		"""
-		pos, row, col = square.pos, cell.row, cell.col
-		cell = self.pcell(row, col)
-		lpair = [-1, -1]
-		lpair[pos] = value
-		for otherval in range(1, self.n + 1):
-			lpair[1 - pos] = otherval
-			pair = tuple(lpair)
-			locations = self.pairs[pair]
-			if isinstance(locations, BaseCell): continue
-			if cell not in locations: continue
-			# log.debug(f'{self.pairname(pair)} not at {self.posname(row,col)}')
-			locations.remove(cell)
-			if len(locations) == 0:
-				raise Unsolvable(f'No location for {self.pairname(pair)}')
+		pos = square.pos
+		mask = ~cell.bit
+		pairs = self.pairs
+		journal = self.journal
+		if pos == 0:
+			prow = pairs[value]
+			for otherval in self.vals:
+				locations = prow[otherval]
+				if isinstance(locations, BaseCell): continue
+				rest = locations & mask
+				if rest == locations:
+					continue
+				if rest == 0:
+					raise Unsolvable(f'No location for {self.pairname((value, otherval))}')
+				journal.append((prow, otherval, locations))
+				prow[otherval] = rest
+		else:
+			for otherval in self.vals:
+				prow = pairs[otherval]
+				locations = prow[value]
+				if isinstance(locations, BaseCell): continue
+				rest = locations & mask
+				if rest == locations:
+					continue
+				if rest == 0:
+					raise Unsolvable(f'No location for {self.pairname((otherval, value))}')
+				journal.append((prow, value, locations))
+				prow[value] = rest
 
 	def rule_singlepairpos(self) -> bool:
 		"""
-		Check if there is a pair that can only occur at a single position. If
-		yes, set both values at that position (left and right) to the fixed value
-		and return True, otherwise return False.
+		Check if there are pairs that can only occur at a single position. If
+		yes, set both values at those positions (left and right) to the fixed
+		value and return True, otherwise return False.
+
+		All singleton pairs found in one scan are placed in one batch, so
+		the outer rule loop needs fewer iterations.
 		"""
-		for pair, val in self.pairs.items():
+		single = []
+		pairs = self.pairs
+		for i in self.vals:
+			prow = pairs[i]
+			for j in self.vals:
+				val = prow[j]
+				if isinstance(val, BaseCell): continue
+				if val & (val - 1) == 0:
+					single.append((i, j))
+		pro = False
+		for pair in single:
+			# Placing one pair may have located or shrunk another, re-read
+			val = self.pairs[pair[0]][pair[1]]
 			if isinstance(val, BaseCell): continue
-			if len(val) > 1: continue
-			if len(val) == 0:
+			if val == 0:
 				raise Unsolvable(f'No remaining location for pair {pair}')
-			pro = False
-			cell = val.pop()  # cell is in left Magicsquare
-			log.debug(f'Pair {self.pair2str(pair)} must be at ({cell.row + 1}, {cell.col + 1})')
-			if isinstance(cell.val, set):
+			# val has a single bit left, locating the pair in the left Magicsquare
+			cell = self.pcells[val.bit_length() - 1]
+			if log.isEnabledFor(logging.DEBUG):
+				log.debug(f'Pair {self.pair2str(pair)} must be at ({cell.row + 1}, {cell.col + 1})')
+			if not cell.is_fix():
 				pro = True
 				cell.setval(pair[0], "Left of single location pair")
 			othercell = self.square[1].getcell(cell.row, cell.col)
-			if isinstance(othercell.val, set):
+			if not othercell.is_fix():
 				pro = True
 				othercell.setval(pair[1], "Right of single location pair")
-			self.pairs[pair] = cell
-			return pro
+			prow = self.pairs[pair[0]]
+			if not isinstance(prow[pair[1]], BaseCell):
+				self.journal.append((prow, pair[1], prow[pair[1]]))
+				prow[pair[1]] = cell
+		return pro
 
 	def setgivens(self, *args):
 		"""
@@ -260,15 +334,15 @@ class Eulero(BasePuzzle):
 		The left cell is rendered as an uppercase char, the right cell as a number,
 		blank for each if no value has been found yet. Then padded to the max width + 1
 		"""
-		v1 = chr(ord('A') + cell.val - 1) if isinstance(cell.val, int) else ' '
-		v2 = self.square[1].getcell(cell.row, cell.col).val
-		v2 = str(v2) if isinstance(v2, int) else ' '
+		v1 = LETTER[cell.val - 1] if cell.is_fix() else ' '
+		other = self.square[1].getcell(cell.row, cell.col)
+		v2 = str(other.val) if other.is_fix() else ' '
 		v2 += ' ' * (len(str(self.n)) - len(v2))
 		return v1 + v2
 
 	def pair2str(self, p) -> str:
 		"""String representation of an eulero cell value"""
-		return chr(ord('A') + p[0] - 1) + str(p[1])
+		return LETTER[p[0] - 1] + str(p[1])
 
 	def quickprint(self, withlines=True):
 		"""
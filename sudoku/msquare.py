@@ -1,19 +1,28 @@
 #!/usr/bin/env python3
-import types
 import logging
+from collections import deque
 
 import cell
 from exceptions import Unsolvable
 
 log = logging.getLogger(__name__)
 
-class BasePuzzle(types.SimpleNamespace):
+class BasePuzzle:
 	"""
 	Abstract base class for symbol placement puzzles
 
+	Backtracking works with a change journal instead of full state
+	snapshots: every mutation during the search appends an undo record
+	to `journal`, a backup is just a mark into that list and a restore
+	pops and undoes the records above the mark. Deep searches thus pay
+	per change, not per cell, on every level. Three record shapes exist:
+	(cell, packedval) restores a cell, (list, index, old) restores one
+	list entry, (list, oldlen) truncates a list that only grew.
+
 	Our child class must provide:
-	- state() function that returns the puzzle's state
-	- restorestate() function that restores a given state
+	- state() function that returns the few cheap counters not covered
+	  by the journal (for a plain puzzle just `remain`)
+	- restorestate() function that restores those counters
 	- findtry() function that returns a cell where the
 	  state() function returns a set of possible values, or None
 	  when no such cell exists.
@@ -21,26 +30,90 @@ class BasePuzzle(types.SimpleNamespace):
 	  exclude values at certain cells or obtain a final values for a
 	  cell. The functions are to return True if any progress has been
 	  made.
+
+	All puzzle classes use __slots__: the solver objects are accessed
+	millions of times during a search, and fixed attribute layout is
+	both faster and smaller than a per-instance __dict__.
 	"""
+	__slots__ = (
+		'journal', 'marks', 'maxlevel', 'xqueue', 'draining', 'remain',
+		'myrules',
+	)
+
 	def __init__(self):
-		self.stack = []
+		self.journal = []
+		self.marks = []
 		self.maxlevel = 0
+		self.xqueue = deque()
+		self.draining = False
+
+	def exclude(self, cell, num):
+		"""
+		Schedule removal of a candidate and work off the queue
+
+		Instead of nesting propagation callbacks ever deeper on the
+		Python call stack, exclusions go through a worklist: the
+		outermost call drains the queue until it is empty, calls made
+		while draining just enqueue and return. Repeated exclusions of
+		the same candidate are no-ops in xclude, so no extra
+		deduplication is needed. When an Unsolvable exception unwinds,
+		the queue is emptied; the backtracker discards the state anyway.
+		"""
+		queue = self.xqueue
+		queue.append((cell, num))
+		if self.draining:
+			return
+		self.draining = True
+		try:
+			popleft = queue.popleft
+			while queue:
+				c, v = popleft()
+				c.xclude(v)
+		finally:
+			self.draining = False
+			queue.clear()
 
 	def backup(self):
 		"""
-		Push a backup of our current state on the stack
+		Mark the current state for a later restore
+
+		Only the journal length and the counters are saved; the actual
+		undo information accumulates in the journal as changes happen.
 		"""
-		self.stack.append((self.remain, self.state()))
-		log.debug(f'Backed up state, now at level {len(self.stack)}')
+		self.marks.append((len(self.journal), self.state()))
+		log.debug('Backed up state, now at level %d', len(self.marks))
 
 	def restore(self):
 		"""
-		Restore the state from top of the stack
+		Undo all changes since the latest mark
 		"""
-		remain, state = self.stack.pop()
+		mark, state = self.marks.pop()
+		journal = self.journal
+		while len(journal) > mark:
+			e = journal.pop()
+			if len(e) == 3:
+				lst, i, old = e
+				lst[i] = old
+			elif isinstance(e[0], cell.BaseCell):
+				e[0].restore(e[1])
+			else:
+				del e[0][e[1]:]
 		self.restorestate(state)
-		self.remain = remain
-		log.debug(f'Restored state, back at level {len(self.stack)}')
+		log.debug('Restored state, back at level %d', len(self.marks))
+
+	def state(self):
+		"""
+		The counters to save next to a journal mark
+
+		Everything else is restored by undoing the journal.
+		"""
+		return self.remain
+
+	def restorestate(self, state):
+		"""
+		Restore the counters saved by state()
+		"""
+		self.remain = state
 
 	def apply_rules(self) -> bool:
 		for rule in self.myrules:
@@ -48,41 +121,68 @@ class BasePuzzle(types.SimpleNamespace):
 				return True
 		return False
 
-	def solve_r(self):
-		level = len(self.stack)
-		if level > self.maxlevel:
-			self.maxlevel = level
-		try:
-			while self.apply_rules() and self.remain > 0:
-				pass
-		except Unsolvable as e:
-			log.debug(f'[{level}] Applying rules: {e}')
-			return False
-		if self.remain == 0:
-			return True
-		self.print()
-		cell = self.findtry()
-		log.debug(f'Pivot {cell.name} with {len(cell.val)} candidates')
-		tryset = cell.val.copy()
-		for cand in tryset:
-			log.debug(f'[{level}] Try setting {cell.name} = {cand}')
-			self.backup()
+	def solve(self):
+		"""
+		Solve the puzzle by rules and backtracking
+
+		The search is iterative: next to the state backups we keep an
+		explicit stack of (cell, candidate iterator) trials, so deep
+		searches neither pay a Python frame per level nor run into the
+		recursion limit.
+
+		Return:
+			self when solved, None when no solution exists
+		"""
+		trials = []
+		while True:
+			level = len(trials)
+			if level > self.maxlevel:
+				self.maxlevel = level
+			dead = False
 			try:
-				cell.setval(cand, f'try-{cand}')
-				if self.solve_r():
-					return True
+				while self.apply_rules() and self.remain > 0:
+					pass
 			except Unsolvable as e:
-				log.debug(f'[{level}] {cand} leads to {e}')
-			self.restore()
-		if level > 0:
-			log.debug(f'[{level}] No solution found')
-		return False
-
-	def solve(self):
-		if self.solve_r():
-			return self
-		else:
-			return None
+				log.debug('[%d] Applying rules: %s', level, e)
+				dead = True
+			if not dead:
+				if self.remain == 0:
+					return self
+				if log.isEnabledFor(logging.DEBUG):
+					# The grid dump is a debug aid; formatting and writing
+					# it per pivot dominates easy puzzles otherwise
+					self.print()
+				cell = self.findtry()
+				if log.isEnabledFor(logging.DEBUG):
+					log.debug(f'Pivot {cell.name} with {cell.ncand()} candidates')
+				trials.append((cell, iter(list(cell.candidates()))))
+			elif trials:
+				# The last trial value led nowhere, take it back
+				self.restore()
+			else:
+				return None
+			# Advance to the next untried candidate value
+			while trials:
+				cell, cands = trials[-1]
+				cand = next(cands, 0)
+				if cand:
+					if log.isEnabledFor(logging.DEBUG):
+						log.debug(f'[{len(trials) - 1}] Try setting {cell.name} = {cand}')
+					self.backup()
+					try:
+						cell.setval(cand, f'try-{cand}')
+						break
+					except Unsolvable as e:
+						log.debug('[%d] %s leads to %s', len(trials) - 1, cand, e)
+						self.restore()
+					continue
+				# All candidates of this pivot failed, backtrack one level
+				trials.pop()
+				if trials:
+					log.debug('[%d] No solution found', len(trials))
+					self.restore()
+			else:
+				return None
 
 
 class Magicsquare(BasePuzzle):
@@ -108,9 +208,12 @@ class Magicsquare(BasePuzzle):
 		as decimal numbers
 	- remain (int): Number of positions that don't have a fixed value
 		yet. Cache to determine when puzzle is solved.
-	- stack (list): Stack of state backups for backtracking
+	- journal (list): Undo records for backtracking, see BasePuzzle
 	- givens (list): List of positions and values given initially
 	- cells (list): Linear list of all cells in the puzzle
+	- cells_by_val (list): For each value the list of cells already
+	  fixed to it, appended to in cellgotval. Reverse index so that
+	  callers need not scan all cells for holders of a value.
 	- myhouse (iterator): iterator over all kinds of houses. Returns
 	  a function that takes a cell C as argument and returns that house
 	  of the given kind that contains C.
@@ -119,6 +222,12 @@ class Magicsquare(BasePuzzle):
 	  finding a solution has been made. It searches
 	  various patterns and deducts new values or exclusions.
 	"""
+	__slots__ = (
+		'N', 'mkcell', 'name', 'digits', 'cells', 'cells_by_val',
+		'rows', 'cols', 'houses', 'housenames', 'myhouse', 'peers',
+		'houseidx', 'pos', 'parent', 'other',
+	)
+
 	def __init__(self, N: int = 5, mkcell=None, name=None):
 		"""
 		Create a magic square
@@ -148,10 +257,32 @@ class Magicsquare(BasePuzzle):
 			[self.cells[j + i * self.N] for i in range(self.N)]
 			for j in range(self.N)
 		]
+		self.cells_by_val = [[] for i in range(self.N + 1)]
 		self.houses = [self.rows, self.cols]
 		self.housenames = ['row', 'col']
+		self.houseidx = {id(h): i for i, h in enumerate(self.houses)}
 		self.myhouse = [self.row, self.col]
 		self.myrules = [self.rule_singlecandidate, self.rule_singlepos]
+		self.mkpeers()
+
+	def mkpeers(self):
+		"""
+		Precompute for every cell the cells sharing a house with it
+
+		Propagation in cellgotval would otherwise walk all house lists
+		through a method call each and filter out the cell itself on
+		every single event. Houses may overlap (e.g. sudoku boxes), so
+		duplicates are dropped. A subclass adding further house kinds
+		must call this again afterwards.
+		"""
+		self.peers = []
+		for c in self.cells:
+			peers = []
+			for house in self.myhouse:
+				for p in house(c):
+					if p is not c and p not in peers:
+						peers.append(p)
+			self.peers.append(tuple(peers))
 
 	def getcell(self, row: int, col: int) -> cell.NCell:
 		"""Cell by row and column numbers"""
@@ -176,9 +307,11 @@ class Magicsquare(BasePuzzle):
 		This may raise an Unsolvable exception.
 		"""
 		self.remain -= 1
-		for house in self.myhouse:
-			for c in house(cell):
-				if c is not cell: c.xclude(val)
+		holders = self.cells_by_val[val]
+		self.journal.append((holders, len(holders)))
+		holders.append(cell)
+		for c in self.peers[cell.idx]:
+			self.exclude(c, val)
 		cellgotval = getattr(getattr(self, 'parent', None), 'cellgotval', None)
 		if cellgotval is not None:
 			cellgotval(self, cell, val)
@@ -204,26 +337,6 @@ class Magicsquare(BasePuzzle):
 		for row, col, val in args:
 			self.getcell(row, col).setval(val, "Set Givens")
 
-	def state(self):
-		"""
-		Value representing the complete state
-
-		This is a value that will be pushed to or popped off the stack.
-		It must be a copy containing no references into the original state,
-		and must contain everything that we want to restore.
-
-		For a sudoku this is the number of remaining cells to be solved and
-		a list of current cells.
-		"""
-		return [cell.state() for cell in self.cells]
-
-	def restorestate(self, state):
-		"""
-		Restore puzzle to the given state
-		"""
-		for i, val in enumerate(state):
-			self.cells[i].restore(val)
-
 	def housename(self, memberlist, n) -> str:
 		"""
 		Return human readable name for a given house
@@ -235,10 +348,11 @@ class Magicsquare(BasePuzzle):
 		Return:
 			Name of the given house
 		"""
-		for idx, mlist in enumerate(self.houses):
-			if memberlist is mlist:
-				return f'{self.housenames[idx]}({n + 1})'
-		raise ValueError(f'Unknown Container {memberlist}')
+		try:
+			idx = self.houseidx[id(memberlist)]
+		except KeyError:
+			raise ValueError(f'Unknown Container {memberlist}') from None
+		return f'{self.housenames[idx]}({n + 1})'
 
 	def rule_singlecandidate(self) -> bool:
 		"""
@@ -251,78 +365,85 @@ class Magicsquare(BasePuzzle):
 			True if a new cell got a fixed value
 		"""
 		for cell in self.cells:
-			if cell.is_fix() or len(cell.val) > 1: continue
-			cell.setval(cell.getany(), 'single-candidate')
+			if cell.is_fix(): continue
+			m = cell.val
+			# Single candidate iff the mask is a power of two
+			if m & (m - 1): continue
+			cell.setval(m.bit_length(), 'single-candidate')
 			return True
 		return False
 
-	def try_singlepos_x(self, x) -> bool:
+	def rule_singlepos(self):
 		"""
 		Apply single position rule
 
-		If for a number x only a single cell in
-		a row, column or box exists where x is a candidate,
-		set that cell to x
+		If for a number x only a single cell in a row, column or box
+		exists where x is a candidate, set that cell to x.
+
+		Instead of scanning every house once per number, each house is
+		scanned once while three value masks are accumulated: the values
+		already fixed in the house, the values seen in any unfixed cell,
+		and the values seen in more than one. The single positions for
+		all numbers at once are then the bits set in exactly one unfixed
+		cell, and a value neither fixed nor seen anywhere makes the
+		house unsolvable.
 
 		Return:
 			True if a new cell got a fixed value
 		"""
+		full = (1 << self.N) - 1
+		pro = False
+		# Bind the per-event lookups once; this loop runs for every house
+		# of every kind on every rule pass
+		housename = self.housename
+		debug = log.isEnabledFor(logging.DEBUG)
 		for houses in self.houses:
-			# When we searched a house for possible locations of x, we need to
-			# differentiate between having found no cell (unsolvable), one
-			# cell that is set already (rule does not apply), one cell that is
-			# not already set (jay) and multiple cells. We use two variables:
-			# `cell` which is set to the cell where the rule applies, or None,
-			# and `found` if the value can be found at all
 			for n, house in enumerate(houses):
-				cell = None
-				found = False
+				fixed = seen = multi = 0
 				for c in house:
 					if c.is_fix():
-						if c.val == x:
-							# Value already set in that house
-							found = True
-							break
-						else:
-							continue
-					if x not in c.val:
-						continue
-					# c has x as candidate
-					found = True
-					if cell is None:
-						# we found the first cell with x as candidate
-						cell = c
+						fixed |= 1 << (c.val - 1)
 					else:
-						# rule not applicable in this house
-						cell = None
-						break
-				where = self.housename(houses, n)
-				if not found:
-					raise Unsolvable(f'In {where}: no {x}')
-				if cell:
-					cell.setval(x, f'In {where}: single place for {x}')
-					return True
-		return False
-
-	def rule_singlepos(self):
-		"""
-		Try singleposition rule for all numbers
-		"""
-		for x in range(1, self.N + 1):
-			if self.try_singlepos_x(x):
-				return True
-		return False
+						m = c.val
+						multi |= seen & m
+						seen |= m
+				if fixed | seen != full:
+					where = housename(houses, n)
+					gone = full & ~(fixed | seen)
+					miss = (gone & -gone).bit_length()
+					raise Unsolvable(f'In {where}: no {miss}')
+				single = seen & ~multi & ~fixed
+				while single:
+					b = single & -single
+					single ^= b
+					x = b.bit_length()
+					for c in house:
+						# Setting an earlier single may have propagated into
+						# this house, so check x is still a candidate here
+						if c.has(x):
+							# The comment only ever shows up in the debug
+							# log, don't format house names without it
+							if debug:
+								where = housename(houses, n)
+								c.setval(x, f'In {where}: single place for {x}')
+							else:
+								c.setval(x, 'single-position')
+							pro = True
+							break
+		return pro
 
 	def findtry(self) -> cell.NCell:
 		"""
 		Find an unsolved cell with the smallest number of potential values
 		"""
 		res = None
+		best = 0
 		for c in self.cells:
 			if c.is_fix(): continue
-			if len(c.val) == 2:
+			nc = c.ncand()
+			if nc == 2:
 				return c
-			if res is None or len(c.val) < len(res.val):
-				res = c
+			if res is None or nc < best:
+				res, best = c, nc
 		return res
 
@@ -15,7 +15,6 @@ alrady been placed.
 A sudoku is implemented as a list of NxN objects of type Cell. Rows, columns
 and boxes are lists of references to the corresponding cells.
 """
-import types
 import logging
 
 from cell import NCell
@@ -37,6 +36,8 @@ class Cell(NCell):
 	"""
 	A single cell
 	"""
+	__slots__ = ()
+
 	def print(self):
 		"""
 		ASCII art representation
@@ -45,7 +46,7 @@ class Cell(NCell):
 		"""
 		def cnd(r, c):
 			num = r * n + c + 1
-			if num in self._val:
+			if self.has(num):
 				return f'{num:{digits}}'
 			else:
 				return ' ' * digits
@@ -54,7 +55,7 @@ class Cell(NCell):
 			"""Fixed cell"""
 			width = (digits + 1) * m - 1
 			res = [' ' * width for ll in range(n)]
-			res[n // 2] = f'({self._val})'.center(width)
+			res[n // 2] = f'({self.val})'.center(width)
 			return res
 
 		def uns():
@@ -86,6 +87,8 @@ class Sudoku(msquare.Magicsquare):
 	in the upper left coner, boxes are numbered first left to right,
 	then top to down.
 	"""
+	__slots__ = ('n', 'm', 'boxs')
+
 	def __init__(self, n: int = 3, m: int = 3):
 		super().__init__(n * m, Cell)
 		self.n = n
@@ -104,7 +107,10 @@ class Sudoku(msquare.Magicsquare):
 		]
 		self.houses.append(self.boxs)
 		self.housenames.append('box')
+		self.houseidx[id(self.boxs)] = len(self.houses) - 1
 		self.myhouse.append(self.box)
+		self.myrules.append(self.rule_lockedcandidates)
+		self.mkpeers()
 
 	def box(self, cell: Cell):
 		"""Box containing the given cell"""
@@ -112,6 +118,70 @@ class Sudoku(msquare.Magicsquare):
 		boxc = cell.col // self.n
 		return self.boxs[boxr * self.m + boxc]
 
+	def rule_lockedcandidates(self) -> bool:
+		"""
+		Apply the locked candidates rule
+
+		If all cells of a box that still allow a value x lie in a single
+		row, x must be placed in that box on that row, so it can be
+		excluded from the rest of the row. The same holds for columns.
+
+		Return:
+			True if any candidate has been excluded
+		"""
+		pro = False
+		for box in self.boxs:
+			if self.lockedinbox(box, True):
+				pro = True
+			if self.lockedinbox(box, False):
+				pro = True
+		return pro
+
+	def lockedinbox(self, box, byrow: bool) -> bool:
+		"""
+		Exclude candidates locked in one box along rows or columns
+
+		The candidates of the box are accumulated into one mask per row
+		(column); a bit set in exactly one of the masks is locked on
+		that line and removed from the line's cells outside the box.
+
+		Return:
+			True if any candidate has been excluded
+		"""
+		inline = {}
+		for c in box:
+			if c.is_fix(): continue
+			k = c.row if byrow else c.col
+			inline[k] = inline.get(k, 0) | c.val
+		if not inline:
+			# Fully fixed box, nothing to deduce. A single remaining line
+			# still locks all its values: out_line is empty then, so the
+			# loop below excludes the whole mask outside the box.
+			return False
+		# Coordinate range the box covers on the other axis
+		lo = box[0].col if byrow else box[0].row
+		hi = lo + (self.n if byrow else self.m)
+		pro = False
+		for k, mask in inline.items():
+			others = 0
+			for kk, m in inline.items():
+				if kk != k:
+					others |= m
+			locked = mask & ~others
+			while locked:
+				b = locked & -locked
+				locked ^= b
+				x = b.bit_length()
+				for c in (self.rows[k] if byrow else self.cols[k]):
+					if lo <= (c.col if byrow else c.row) < hi:
+						continue
+					if c.has(x):
+						if log.isEnabledFor(logging.DEBUG):
+							log.debug(f'Locked {x} in box, excluded at {c.name}')
+						self.exclude(c, x)
+						pro = True
+		return pro
+
 	def print(self):
 		"""
 		ASCII art representation